@@ -1,8 +1,29 @@
-import aiohttp
+import asyncio
+import contextvars
+import time
 
-from traitlets import List, Unicode, default
+import httpx
+import orjson
+
+from traitlets import Int, List, Unicode, default
 from oauthenticator.generic import GenericOAuthenticator
 
+# Keys of the Canvas user profile in auth_state passed to the spawner, and their
+# environment variable names. Others are lti_user_id, id, integration_id.
+_CANVAS_USER_ENV = tuple(
+    (k, f"OAUTH2_{k.upper()}")
+    for k in ("login_id", "name", "sortable_name", "primary_email")
+)
+
+
+# Longest Retry-After, in seconds, that we wait out before giving up on a
+# Canvas request. Logins can't reasonably wait for longer.
+_MAX_RETRY_AFTER = 10
+
+# Event loop time by which the current login's Canvas fetch must finish. It is
+# inherited by the tasks that asyncio.gather creates for concurrent requests.
+_fetch_deadline = contextvars.ContextVar("_fetch_deadline", default=None)
+
 
 class CanvasOAuthenticator(GenericOAuthenticator):
     """
@@ -61,6 +82,52 @@ class CanvasOAuthenticator(GenericOAuthenticator):
         """,
     )
 
+    cache_ttl = Int(
+        60,
+        config=True,
+        help="""
+        Number of seconds to cache a user's Canvas courses and groups.
+
+        A user who logs in again within this period will not have their
+        courses and groups fetched from Canvas again, so changes in Canvas
+        may take this long to be reflected. Caching is enabled by default;
+        set to 0 to disable.
+        """,
+    )
+
+    max_concurrency = Int(
+        8,
+        min=1,
+        config=True,
+        help="""
+        Maximum number of concurrent requests to Canvas per login.
+        """,
+    )
+
+    max_retries = Int(
+        3,
+        min=0,
+        config=True,
+        help="""
+        Number of times to retry a Canvas request that was rate limited
+        (HTTP 429) or found the service unavailable (HTTP 503).
+
+        The Retry-After response header is honored, defaulting to 1 second.
+        Requests asking for a longer wait than 10 seconds, or for a wait that
+        would exceed fetch_timeout, are not retried.
+        """,
+    )
+
+    fetch_timeout = Int(
+        30,
+        min=1,
+        config=True,
+        help="""
+        Number of seconds allowed to fetch a user's courses and groups from
+        Canvas during login, including pagination and retries.
+        """,
+    )
+
     @default("canvas_course_key")
     def _default_canvas_course_key(self):
         """
@@ -91,8 +158,11 @@ class CanvasOAuthenticator(GenericOAuthenticator):
 
         self.token_url = f"{self.canvas_url}login/oauth2/token"
         self.userdata_url = f"{self.canvas_url}api/v1/users/self/profile"
+        self.courses_url = f"{self.canvas_url}api/v1/courses"
+        self.self_groups_url = f"{self.canvas_url}api/v1/users/self/groups"
 
-        self.extra_params = {
+        # These are only sent to the token endpoint, never to the API.
+        self.token_params = {
             "client_id": self.client_id,
             "client_secret": self.client_secret,
             # We set replace_tokens=1 to prevent tokens from accumulating.
@@ -100,54 +170,168 @@ class CanvasOAuthenticator(GenericOAuthenticator):
             "replace_tokens": 1,
         }
 
-    async def get_canvas_items(self, token, url):
+        # Maps (cache_key, url) to (expires_at, items)
+        self._canvas_cache = {}
+
+    async def fetch_canvas_page(self, client, semaphore, token, url, params=None):
+        """
+        Fetch a single page of items from Canvas.
+
+        semaphore bounds the number of requests in flight for this login.
+        Returns the decoded items along with the parsed Link header.
+        """
+        headers = dict(Authorization=f"Bearer {token}")
+
+        for attempt in range(self.max_retries + 1):
+            async with semaphore:
+                r = await client.get(url, headers=headers, params=params)
+            if r.status_code in (429, 503) and attempt < self.max_retries:
+                try:
+                    delay = max(float(r.headers.get("Retry-After", 1)), 0)
+                except ValueError:
+                    # Retry-After may also be an HTTP date
+                    delay = 1
+            else:
+                delay = None
+            deadline = _fetch_deadline.get()
+            if (
+                delay is None
+                or delay > _MAX_RETRY_AFTER
+                or (
+                    deadline is not None
+                    and asyncio.get_running_loop().time() + delay >= deadline
+                )
+            ):
+                r.raise_for_status()
+                return orjson.loads(r.content), r.links
+            self.log.warning(
+                f"Canvas returned {r.status_code} for {url}, retrying in {delay}s"
+            )
+            await asyncio.sleep(delay)
+
+    async def get_canvas_items(
+        self, client, semaphore, token, url, params=None, cache_key=None
+    ):
         """
         Get paginated items from Canvas.
         https://canvas.instructure.com/doc/api/file.pagination.html
+
+        When the Link header advertises a numbered `last` page, the remaining
+        pages are requested concurrently. Otherwise the `next` links are
+        followed. Canvas may use opaque bookmarks instead of page numbers.
+
+        params are only sent with the first request, since the Link header
+        URLs already carry them.
+
+        If cache_key is set, e.g. to the username, items are cached for
+        cache_ttl seconds.
         """
-        headers = dict(Authorization=f"Bearer {token}")
-        data = []
+        now = time.monotonic()
+        if cache_key is not None and self.cache_ttl > 0:
+            cached = self._canvas_cache.get((cache_key, url))
+            if cached is not None and now < cached[0]:
+                return cached[1]
+
+        try:
+            data = await self.fetch_canvas_items(
+                client, semaphore, token, url, params
+            )
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 401 and cache_key is not None:
+                # The user's authorization changed, so drop all their items.
+                for key in [k for k in self._canvas_cache if k[0] == cache_key]:
+                    del self._canvas_cache[key]
+            raise
+
+        if cache_key is not None and self.cache_ttl > 0:
+            # Drop expired entries so the cache doesn't grow unbounded.
+            for key in [k for k, v in self._canvas_cache.items() if v[0] <= now]:
+                del self._canvas_cache[key]
+            self._canvas_cache[(cache_key, url)] = (now + self.cache_ttl, data)
+
+        return data
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers, params=self.extra_params) as r:
-                if r.status != 200:
-                    raise Exception(
-                        f"error fetching items {url} -- {r.status} -- {r.text()}"
+    async def fetch_canvas_items(self, client, semaphore, token, url, params=None):
+        """
+        Fetch all pages of items from Canvas, bypassing the cache.
+        """
+        data, links = await self.fetch_canvas_page(
+            client, semaphore, token, url, params
+        )
+
+        last_page = links.get("last", {}).get("url")
+        if last_page is not None:
+            last_page = httpx.URL(last_page)
+        if last_page is not None and last_page.params.get("page", "").isdigit():
+            pages = await asyncio.gather(
+                *(
+                    self.fetch_canvas_page(
+                        client,
+                        semaphore,
+                        token,
+                        last_page.copy_set_param("page", page),
                     )
-                data = await r.json()
-                if "next" in r.links.keys():
-                    url = r.links["next"]["url"]
-                    data += await self.get_canvas_items(token, url)
+                    for page in range(2, int(last_page.params["page"]) + 1)
+                )
+            )
+            for page_data, _ in pages:
+                data.extend(page_data)
+        else:
+            next_page = links.get("next")
+            while next_page is not None:
+                page_data, links = await self.fetch_canvas_page(
+                    client, semaphore, token, next_page["url"]
+                )
+                data.extend(page_data)
+                next_page = links.get("next")
 
         return data
 
-    async def get_courses(self, token):
+    async def get_courses(self, client, semaphore, token, cache_key=None):
         """
         Get list of active courses for the current user.
 
         See https://canvas.instructure.com/doc/api/courses.html#method.courses.index
         """
-        url = f"{self.canvas_url}/api/v1/courses"
-
-        data = await self.get_canvas_items(token, url)
+        # Request the largest page size Canvas allows to minimize round trips.
+        # Enrollments are included in course objects by default.
+        params = {"per_page": 100}
+
+        data = await self.get_canvas_items(
+            client,
+            semaphore,
+            token,
+            self.courses_url,
+            params=params,
+            cache_key=cache_key,
+        )
 
         return data
 
-    async def get_self_groups(self, token):
+    async def get_self_groups(self, client, semaphore, token, cache_key=None):
         """
         Get list of active groups for the current user.
 
         See https://canvas.instructure.com/doc/api/groups.html#method.groups.index
         """
-        url = f"{self.canvas_url}/api/v1/users/self/groups"
+        params = {"per_page": 100}
 
-        data = await self.get_canvas_items(token, url)
+        data = await self.get_canvas_items(
+            client,
+            semaphore,
+            token,
+            self.self_groups_url,
+            params=params,
+            cache_key=cache_key,
+        )
 
         return data
 
     def format_jupyterhub_group(self, *terms):
         """
         Return a group name assembled from provided terms.
+
+        The group builders below inline this for their fixed-shape names.
         """
         return "::".join(map(str, terms))
 
@@ -158,32 +342,42 @@ class CanvasOAuthenticator(GenericOAuthenticator):
           course::{course_id}
           course::{course_id}::enrollment_type::{enrollment_type}
         """
-        groups = []
+        # The same course may be listed more than once, e.g. when a user has
+        # several enrollments in it. We use a set to eliminate duplicates.
+        groups = set()
+        self._add_course_groups(groups, courses)
+        return list(groups)
+
+    def _add_course_groups(self, groups, courses):
+        """Add group identifiers for canvas courses to the set `groups`."""
+        key = self.canvas_course_key
+        add = groups.add
 
         for course in courses:
-            course_id = course.get(self.canvas_course_key, None)
+            # The key is almost always present, though it may be null, e.g.
+            # sis_course_id for courses without SIS data.
+            try:
+                course_id = course[key]
+            except KeyError:
+                continue
             if course_id is None:
                 continue
 
             # Creates `course::{course_id}`
-            groups.append(self.format_jupyterhub_group("course", course_id))
+            add(f"course::{course_id}")
 
             # examples: [{'enrollment_state': 'active', 'role': 'TeacherEnrollment', 'role_id': 1773, 'type': 'teacher', 'user_id': 12345}],
             # https://canvas.instructure.com/doc/api/courses.html#method.courses.index
             # There may be multiple (or even duplicate) enrollments per course
-            enrollment_types = set(
-                map(lambda x: x.get("type", None), course.get("enrollments", []))
-            )
+            try:
+                enrollments = course["enrollments"]
+            except KeyError:
+                continue
+            enrollment_types = {e["type"] for e in enrollments if "type" in e}
 
             # Creates `course::{course_id}::enrollment_type::{enrollment_type}`
             for enrollment_type in enrollment_types:
-                groups.append(
-                    self.format_jupyterhub_group(
-                        "course", course_id, "enrollment_type", enrollment_type
-                    )
-                )
-
-        return groups
+                add(f"course::{course_id}::enrollment_type::{enrollment_type}")
 
     def groups_from_canvas_groups(self, self_groups):
         """
@@ -196,7 +390,11 @@ class CanvasOAuthenticator(GenericOAuthenticator):
         # There is no way to distinguish if the same group name appears in
         # multiple group sets. We use a set to eliminate duplicates.
         groups = set()
+        self._add_self_groups(groups, self_groups)
+        return list(groups)
 
+    def _add_self_groups(self, groups, self_groups):
+        """Add group identifiers for canvas groups to the set `groups`."""
         for group in self_groups:
             if "name" not in group:
                 continue
@@ -206,11 +404,7 @@ class CanvasOAuthenticator(GenericOAuthenticator):
             # The corresponding id field, e.g. `course_id` or `account_id`
             context_id_field = context_type + "_id"
             context_id = group.get(context_id_field, 0)
-            groups.add(
-                self.format_jupyterhub_group(context_type, context_id, "group", name)
-            )
-
-        return list(groups)
+            groups.add(f"{context_type}::{context_id}::group::{name}")
 
     async def update_auth_model(self, auth_model):
         """
@@ -220,39 +414,73 @@ class CanvasOAuthenticator(GenericOAuthenticator):
         auth_model = await super().update_auth_model(auth_model)
 
         access_token = auth_model["auth_state"]["access_token"]
-        courses = await self.get_courses(access_token)
+        username = auth_model["name"]
+
+        async def fetch(client, semaphore):
+            if self.manage_groups:
+                # Courses and groups are independent, so fetch them concurrently.
+                return await asyncio.gather(
+                    self.get_courses(client, semaphore, access_token, username),
+                    self.get_self_groups(client, semaphore, access_token, username),
+                )
+            courses = await self.get_courses(client, semaphore, access_token, username)
+            return courses, None
+
+        # Share one client across all requests. With HTTP/2, concurrent
+        # requests are multiplexed over a single connection, so a semaphore
+        # rather than the connection pool bounds how many are in flight.
+        # The client's timeout applies per request; wait_for bounds the whole
+        # fetch, including retries and pagination.
+        async with httpx.AsyncClient(
+            http2=True, timeout=self.fetch_timeout, follow_redirects=True
+        ) as client:
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            deadline_token = _fetch_deadline.set(
+                asyncio.get_running_loop().time() + self.fetch_timeout
+            )
+            try:
+                courses, self_groups = await asyncio.wait_for(
+                    fetch(client, semaphore), timeout=self.fetch_timeout
+                )
+            except asyncio.TimeoutError:
+                self.log.error(
+                    f"Timed out after {self.fetch_timeout}s fetching Canvas "
+                    f"courses and groups for {username}"
+                )
+                raise
+            finally:
+                _fetch_deadline.reset(deadline_token)
 
         # Preserve courses in auth_state for later use by the spawner
         auth_model["auth_state"]["courses"] = courses
 
         if self.manage_groups:
-            course_group_names = self.groups_from_canvas_courses(courses)
-
-            self_groups = await self.get_self_groups(access_token)
-            self_group_names = self.groups_from_canvas_groups(self_groups)
-
-            groups = course_group_names + self_group_names
-            auth_model["auth_state"][self.auth_state_groups_key] = groups
+            # Build all group names into a single set
+            groups = set()
+            self._add_course_groups(groups, courses)
+            self._add_self_groups(groups, self_groups)
+            auth_model["auth_state"][self.auth_state_groups_key] = list(groups)
         return auth_model
 
     def normalize_username(self, username):
         """Strip the user's email domain, if enabled."""
         username = username.lower()
-        if self.strip_email_domain and username.endswith("@" + self.strip_email_domain):
-            return username.split("@")[0]
+        if self.strip_email_domain:
+            return username.removesuffix(f"@{self.strip_email_domain}")
         return username
 
     async def pre_spawn_start(self, user, spawner):
         """Pass oauth data to spawner via OAUTH2_ prefixed env variables."""
-        auth_state = yield user.get_auth_state()
+        auth_state = await user.get_auth_state()
         if not auth_state:
             return
+        env = spawner.environment
         if "access_token" in auth_state:
-            spawner.environment["OAUTH2_ACCESS_TOKEN"] = auth_state["access_token"]
-        # others are lti_user_id, id, integration_id
-        if "oauth_user" in auth_state:
-            for k in ["login_id", "name", "sortable_name", "primary_email"]:
-                if k in auth_state["oauth_user"]:
-                    spawner.environment[f"OAUTH2_{k.upper()}"] = auth_state[
-                        "oauth_user"
-                    ][k]
\ No newline at end of file
+            env["OAUTH2_ACCESS_TOKEN"] = auth_state["access_token"]
+        # The Canvas user profile, stored by OAuthenticator.
+        canvas_user = auth_state.get(self.user_auth_state_key)
+        if not canvas_user:
+            return
+        for k, env_name in _CANVAS_USER_ENV:
+            if k in canvas_user:
+                env[env_name] = canvas_user[k]
@@ -3,10 +3,11 @@ from setuptools import setup, find_packages
 setup(
     name='jupyterhub-canvasoauthenticator',
     version='0.1',
-    python_requires='>=3.5',
+    python_requires='>=3.9',
     packages=find_packages(),
     install_requires=[
         'oauthenticator',
-        'aiohttp'
+        'httpx[http2]',
+        'orjson'
     ]
 )